@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 import base64
+import tempfile
 
 from docutils.nodes import reference
 
+from .mp_label import MPLabelSpool, SPOOL_MAX_SIZE
 from .mp_request import MPProvider
 from odoo.tools.zeep.helpers import serialize_object
 
@@ -90,75 +92,110 @@ class Providermp(models.Model):
 
     def mp_send_shipping(self, pickings):
         mp_provider = MPProvider(logging.getLogger(__name__), self.sudo().mp_username, self.sudo().mp_password)
+        # Reject the whole wave up front rather than failing halfway through the remote calls
+        errors = mp_provider.check_required_values(self, pickings)
+        if errors:
+            raise UserError('\n'.join('%s: %s' % (picking.name, errors[picking.id])
+                                       for picking in pickings if picking.id in errors))
         res = []
-        for picking in pickings:
-            if picking:
-                # Generate a PDF using Odoo's report action
-                result, report_format = self.env['ir.actions.report']._render_qweb_pdf('studio_customization.abholschein_4a016bec-b09d-44ea-897f-abdcc8d1ec1c',
-                                                [picking.id])
-                print('Lieferschein － ' + picking.name + '.pdf')
-
-                # Encode the PDF content in Base64
-                pdf_base64 = base64.b64encode(result)
-
-                result_picking_list, report_format = self.env['ir.actions.report']._render_qweb_pdf('stock.report_picking',
-                                                [picking.id])
-                print('Picking_List － ' + picking.name + '.pdf')
-
-                # Encode the PDF content in Base64
-                pdf_base64_picking_list = base64.b64encode(result_picking_list)
-
-
-                response = mp_provider.call_shipping_remote({
-                    'action': 'shipment',
-                    'warehouse': picking.location_id.warehouse_id.name,
-                    'shipping_method': self.mp_default_package_type_id.shipper_package_code,
-                    'consignee': mp_provider._set_consignee(picking.partner_id),
-                    'consignor': mp_provider._set_shipper(picking.company_id.partner_id,
-                                                          picking.picking_type_id.warehouse_id.partner_id),
-                    'reference_no': picking.sale_id.name + '_' + picking.name if picking.sale_id else picking.name,
-                    'details': mp_provider._set_shipment_details(picking),
-                    'file_base64': pdf_base64.decode('utf-8'),
-                    'file_name': 'Lieferschein － ' + picking.name + '.pdf',
-                    'file_base64_picking_list': pdf_base64_picking_list.decode('utf-8'),
-                    'file_name_picking_list': 'Picking_List － ' + picking.name + '.pdf'
-                })
-
-                if response.get('status') == 200:
-                    tracking_number = response['data']['tracking_number']
-                else:
-                    raise UserError(response['msg'])
-
-                picking.message_post(body='Shipping to the Logistics Center has been successfully completed {} : {}, '
-                                          'Please proceed to the Logistics Center for the next steps'
-                                     .format(picking.name, tracking_number))
-
-                '''
-                if response['data'].get('shipping_message', ''):
-                    picking.message_post(body='Shipping Message for picking {} : {} '
-                                         .format(picking.name, response['data'].get('shipping_message', '')))
-
-                if response['data'].get('warehouse_message', ''):
-                    picking.message_post(body='Warehouse Sending Message for picking {} : {} '
-                                         .format(picking.name, response['data'].get('warehouse_message', '')))
-
-                if response['data'].get('label', ''):
-                    pdf_data = base64.b64decode(response['data']['label'])
-
-                    mp_labels = [('%s.%s' % (tracking_number, self.mp_label_format),
-                                  pdf_data)]
-
-                    picking.message_post(body='MP Delivery Documents', attachments=mp_labels)
-                '''
+        labelled_pickings = self.env['stock.picking']
+        # A single spool for the whole wave, closed even if a remote call fails
+        with MPLabelSpool() as label_spool:
+            for picking in pickings:
+                if picking:
+                    # Generate a PDF using Odoo's report action
+                    result, report_format = self.env['ir.actions.report']._render_qweb_pdf('studio_customization.abholschein_4a016bec-b09d-44ea-897f-abdcc8d1ec1c',
+                                                    [picking.id])
+
+                    # Encode the PDF content in Base64
+                    pdf_base64 = base64.b64encode(result)
+
+                    result_picking_list, report_format = self.env['ir.actions.report']._render_qweb_pdf('stock.report_picking',
+                                                    [picking.id])
+
+                    # Encode the PDF content in Base64
+                    pdf_base64_picking_list = base64.b64encode(result_picking_list)
+
+
+                    response = mp_provider.call_shipping_remote({
+                        'action': 'shipment',
+                        'warehouse': picking.location_id.warehouse_id.name,
+                        'shipping_method': self.mp_default_package_type_id.shipper_package_code,
+                        'consignee': mp_provider._set_consignee(picking.partner_id),
+                        'consignor': mp_provider._set_shipper(picking.company_id.partner_id,
+                                                              picking.picking_type_id.warehouse_id.partner_id),
+                        'reference_no': picking.sale_id.name + '_' + picking.name if picking.sale_id else picking.name,
+                        'details': mp_provider._set_shipment_details(picking),
+                        'file_base64': pdf_base64.decode('utf-8'),
+                        'file_name': 'Lieferschein － ' + picking.name + '.pdf',
+                        'file_base64_picking_list': pdf_base64_picking_list.decode('utf-8'),
+                        'file_name_picking_list': 'Picking_List － ' + picking.name + '.pdf'
+                    })
+
+                    if response.get('status') == 200:
+                        tracking_number = response['data']['tracking_number']
+                    else:
+                        raise UserError(response['msg'])
+
+                    picking.message_post(body='Shipping to the Logistics Center has been successfully completed {} : {}, '
+                                              'Please proceed to the Logistics Center for the next steps'
+                                         .format(picking.name, tracking_number))
+
+                    if response['data'].get('shipping_message', ''):
+                        picking.message_post(body='Shipping Message for picking {} : {} '
+                                             .format(picking.name, response['data'].get('shipping_message', '')))
+
+                    if response['data'].get('warehouse_message', ''):
+                        picking.message_post(body='Warehouse Sending Message for picking {} : {} '
+                                             .format(picking.name, response['data'].get('warehouse_message', '')))
+
+                    if response['data'].get('label', ''):
+                        label_spool.add(picking.name, base64.b64decode(response['data']['label']))
+                        labelled_pickings |= picking
+
+                    shipping_data = {
+                        'exact_price': 0,
+                        'tracking_number': tracking_number,
+                    }
+
+                    res.append(shipping_data)
+
+            if label_spool:
+                self._mp_attach_wave_labels(labelled_pickings, label_spool)
 
-                shipping_data = {
-                    'exact_price': 0,
-                    'tracking_number': tracking_number,
-                }
+        return res
 
-                res.append(shipping_data)
+    def _mp_attach_wave_labels(self, pickings, label_spool):
+        """Store the labels of a wave as one printable attachment.
 
-        return res
+        A single message is posted on the first picking of the wave instead of
+        one message per picking, so the warehouse can print the whole wave at once.
+        The merged document is written to a spooled file; it is only read back
+        once, as ir.attachment stores its content from bytes.
+        """
+        if len(pickings) > 1:
+            wave_name = '%s - %s' % (pickings[0].name, pickings[-1].name)
+        else:
+            wave_name = pickings.name
+        attachment = self.env['ir.attachment']
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as wave_stream:
+            page_count, skipped = label_spool.merge(wave_stream)
+            if page_count:
+                wave_stream.seek(0)
+                attachment = attachment.create({
+                    'name': 'MP Labels %s.pdf' % wave_name,
+                    'raw': wave_stream.read(),
+                    'mimetype': 'application/pdf',
+                    'res_model': pickings._name,
+                    'res_id': pickings[0].id,
+                })
+        body = []
+        merged_names = [name for name in pickings.mapped('name') if name not in skipped]
+        if merged_names:
+            body.append('MP Delivery Documents for pickings: {}'.format(', '.join(merged_names)))
+        if skipped:
+            body.append('The labels of the following pickings could not be merged: {}'.format(', '.join(skipped)))
+        pickings[0].message_post(body='. '.join(body), attachment_ids=attachment.ids)
 
     def mp_get_return_label(self, picking, tracking_number=None, origin_date=None):
         return super(Providermp, self).get_return_label(picking, tracking_number, origin_date)
@@ -177,6 +214,41 @@ class Providermp(models.Model):
         weight = weight_uom_id._compute_quantity(weight, self.env.ref('uom.product_uom_kgm'), round=False)
         return float_repr(weight, 3)
 
+    def _mp_weight_conversion_factor(self):
+        """Factor converting a weight in the configured weight UoM to kilograms,
+        to convert many weights without looking the UoMs up each time."""
+        weight_uom_id = self.env['product.template']._get_weight_uom_id_from_ir_config_parameter()
+        return self.env.ref('uom.product_uom_kgm').factor / weight_uom_id.factor
+
+    def _mp_reserve_commercial_invoice_numbers(self, count):
+        """Reserve a block of ``count`` commercial invoice numbers at once
+        instead of calling next_by_code (and locking the sequence) per picking."""
+        company_id = self.env.company.id
+        sequence = self.env['ir.sequence'].sudo().search([
+            ('code', '=', 'delivery_mp.commercial_invoice'),
+            ('company_id', 'in', [company_id, False])
+        ], order='company_id', limit=1)
+        if not sequence:
+            raise UserError(_('The commercial invoice sequence of MP is missing.'))
+        if sequence.use_date_range:
+            return [sequence._next() for dummy in range(count)]
+        # Both branches mirror the private ir.sequence helpers of Odoo 16.0 (_select_nextval and
+        # _update_nogap), drawing ``count`` numbers at once: check them again when upgrading Odoo.
+        if sequence.implementation == 'standard':
+            # The numbers are handed out to the pickings by position, so they must come back in order
+            self.env.cr.execute(
+                "SELECT nextval('ir_sequence_%03d') FROM generate_series(1, %%s) ORDER BY 1" % sequence.id, [count])
+            # Odoo creates the PostgreSQL sequence without MAXVALUE, so its increment cannot be negative
+            numbers = [row[0] for row in self.env.cr.fetchall()]
+        else:
+            self.env.cr.execute("SELECT number_next FROM ir_sequence WHERE id=%s FOR UPDATE NOWAIT", [sequence.id])
+            number_next = self.env.cr.fetchone()[0]
+            self.env.cr.execute("UPDATE ir_sequence SET number_next=number_next+%s WHERE id=%s",
+                                [count * sequence.number_increment, sequence.id])
+            sequence.invalidate_recordset(['number_next'])
+            numbers = range(number_next, number_next + count * sequence.number_increment, sequence.number_increment)
+        return [sequence.get_next_char(number) for number in numbers]
+
     def _mp_add_custom_data_to_request(self, request, request_type):
         """Adds the custom data to the request.
         When there are multiple items in a list, they will all be affected by
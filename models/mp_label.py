@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+import io
+import logging
+import tempfile
+
+from PIL import Image
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
+try:
+    from PyPDF2.errors import PyPdfError
+except ImportError:
+    # PyPDF2 1.x
+    from PyPDF2.utils import PyPdfError
+
+from odoo.tools.pdf import PdfFileReader
+
+_logger = logging.getLogger(__name__)
+
+PDF_SIGNATURE = b'%PDF'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Labels stay in memory up to this size, the spool rolls over to a single temporary file afterwards
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+# Object numbers of the wave document catalog and page tree, the labels objects come after them
+CATALOG_NUMBER = 1
+PAGES_NUMBER = 2
+
+
+def label_to_pdf(label):
+    """Return the label as PDF bytes, or None if its format is unknown.
+
+    The format is detected from the label content rather than the carrier
+    setting, as the API does not always return what was configured.
+    """
+    # The PDF header may be preceded by some garbage, readers accept it in the first 1024 bytes
+    if PDF_SIGNATURE in label[:1024]:
+        return label
+    if label.startswith(PNG_SIGNATURE):
+        pdf_stream = io.BytesIO()
+        with Image.open(io.BytesIO(label)) as image:
+            # Keep black and white labels as they are, converting them to RGB makes the page 24 times larger
+            if image.mode not in ('1', 'L', 'RGB', 'CMYK'):
+                image = image.convert('RGB')
+            image.save(pdf_stream, format='PDF')
+        return pdf_stream.getvalue()
+    return None
+
+
+def _get_object(reference):
+    # get_object is the PyPDF2 >= 2.0 name, getObject was removed in 3.0
+    return reference.get_object() if hasattr(reference, 'get_object') else reference.getObject()
+
+
+def _get_indirect_reference(page):
+    # indirect_reference is the PyPDF2 >= 2.10 name, indirectRef the 1.x one; both are plain
+    # attributes, unlike the deprecated indirect_ref property of 2.x
+    page_attributes = vars(page)
+    return page_attributes.get('indirect_reference', page_attributes.get('indirectRef'))
+
+
+def _write_object(output, pdf_object):
+    # write_to_stream is the PyPDF2 >= 2.0 name, writeToStream was removed in 3.0
+    write_to_stream = getattr(pdf_object, 'write_to_stream', None) or pdf_object.writeToStream
+    write_to_stream(output, None)
+
+
+class MPLabelSpool():
+    """Collects the labels of a wave back to back in one spooled file.
+
+    Whatever the size of the wave, at most one file is open, and the decoded
+    labels are not kept in memory while the remote calls are running. Use it
+    as a context manager so the file is closed even if the wave fails.
+    """
+
+    def __init__(self):
+        self.stream = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self.stream.close()
+
+    def add(self, name, label):
+        offset = self.stream.seek(0, io.SEEK_END)
+        self.stream.write(label)
+        self.entries.append((name, offset, len(label)))
+
+    def labels(self):
+        """Yield (name, label) pairs, reading one label at a time from the spool."""
+        for name, offset, size in self.entries:
+            self.stream.seek(offset)
+            yield name, self.stream.read(size)
+
+    def merge(self, output):
+        """Write all the labels as one PDF document into ``output``.
+
+        PdfFileWriter keeps every source page until the document is written and
+        its object deduplication is quadratic in the number of pages, which does
+        not scale to waves of thousands of labels. Instead, the objects of each
+        label are renumbered and written to ``output`` as soon as the label is
+        read, then the label is released; only the object offsets and the page
+        numbers are kept until the page tree and cross-reference table are
+        written at the end.
+        Returns the number of pages merged and the names of the labels that
+        could not be merged.
+        """
+        start = output.tell()
+        output.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+        offsets = {}
+        page_numbers = []
+        skipped = []
+        next_number = PAGES_NUMBER + 1
+        for name, label in self.labels():
+            try:
+                pdf_label = label_to_pdf(label)
+                if pdf_label is None:
+                    _logger.warning("Unknown format for MP label %s, it is left out of the wave document", name)
+                    skipped.append(name)
+                    continue
+                label_objects, label_offsets, label_pages, label_next_number = self._write_label(
+                    PdfFileReader(io.BytesIO(pdf_label), strict=False), next_number)
+            except (PyPdfError, OSError):
+                # Broken PDF or image (PIL raises OSError subclasses), any other error is a bug
+                _logger.warning("MP label %s cannot be read, it is left out of the wave document", name,
+                                exc_info=True)
+                skipped.append(name)
+                continue
+            label_start = output.tell() - start
+            output.write(label_objects)
+            offsets.update((number, label_start + offset) for number, offset in label_offsets.items())
+            page_numbers += label_pages
+            next_number = label_next_number
+
+        offsets[PAGES_NUMBER] = output.tell() - start
+        output.write(b'%d 0 obj\n<< /Type /Pages /Count %d /Kids [' % (PAGES_NUMBER, len(page_numbers)))
+        output.write(b' '.join(b'%d 0 R' % number for number in page_numbers))
+        output.write(b'] >>\nendobj\n')
+        offsets[CATALOG_NUMBER] = output.tell() - start
+        output.write(b'%d 0 obj\n<< /Type /Catalog /Pages %d 0 R >>\nendobj\n' % (CATALOG_NUMBER, PAGES_NUMBER))
+
+        xref_offset = output.tell() - start
+        output.write(b'xref\n0 %d\n0000000000 65535 f \n' % next_number)
+        for number in range(1, next_number):
+            output.write(b'%010d 00000 n \n' % offsets[number])
+        output.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                     % (next_number, CATALOG_NUMBER, xref_offset))
+        return len(page_numbers), skipped
+
+    def _write_label(self, reader, next_number):
+        """Serialize the pages of a label and every object they use, renumbered from ``next_number``.
+
+        The page tree of the label is not copied, its pages are attached to the
+        page tree of the wave document instead. The label is written to a buffer
+        so that a label failing halfway does not corrupt the wave document.
+        Returns the serialized objects, their offsets in the buffer, the page
+        numbers and the next free object number.
+        """
+        buffer = io.BytesIO()
+        offsets = {}
+        page_numbers = []
+        numbers = {}
+        pending = []
+
+        def renumber(pdf_object):
+            nonlocal next_number
+            if isinstance(pdf_object, IndirectObject):
+                if pdf_object.pdf is None:
+                    # Already points to an object of the wave document
+                    return pdf_object
+                key = (pdf_object.idnum, pdf_object.generation)
+                if key not in numbers:
+                    numbers[key] = next_number
+                    next_number += 1
+                    pending.append((numbers[key], _get_object(pdf_object)))
+                return IndirectObject(numbers[key], 0, None)
+            if isinstance(pdf_object, DictionaryObject):
+                for key, value in list(pdf_object.items()):
+                    pdf_object[key] = renumber(value)
+            elif isinstance(pdf_object, ArrayObject):
+                for index, value in enumerate(pdf_object):
+                    pdf_object[index] = renumber(value)
+            return pdf_object
+
+        for page in reader.pages:
+            page_numbers.append(next_number)
+            # Objects referring back to the page (e.g. annotations) must not copy it a second time
+            page_ref = _get_indirect_reference(page)
+            if page_ref is not None:
+                numbers[page_ref.idnum, page_ref.generation] = next_number
+            page[NameObject('/Parent')] = IndirectObject(PAGES_NUMBER, 0, None)
+            pending.append((next_number, page))
+            next_number += 1
+            while pending:
+                number, pdf_object = pending.pop()
+                # The references are renumbered in place, the reader is dropped once the label is written
+                pdf_object = renumber(pdf_object)
+                offsets[number] = buffer.tell()
+                buffer.write(b'%d 0 obj\n' % number)
+                _write_object(buffer, pdf_object)
+                buffer.write(b'\nendobj\n')
+        return buffer.getvalue(), offsets, page_numbers, next_number
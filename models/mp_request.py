@@ -10,6 +10,13 @@ from odoo import _
 from odoo.exceptions import UserError
 from odoo.tools import float_repr, float_round
 
+# Partner and product fields read by the batch pre-flight validation
+ADDRESS_FIELDS = ['street', 'street2', 'city', 'zip', 'phone', 'country_id']
+PRODUCT_FIELDS = ['name', 'weight', 'type']
+# Partner fields the address payloads are built from
+ADDRESS_PAYLOAD_FIELDS = ['name', 'commercial_company_name', 'street', 'street2', 'city', 'state_id', 'zip',
+                          'country_id', 'phone', 'email']
+
 
 class MPProvider():
 
@@ -18,9 +25,13 @@ class MPProvider():
         #self.url = 'http://localhost:8000/api/odoo/logistics'
         self.url = 'http://logistic-center.multipunkt.de/api/odoo/logistics'
         self.headers = {
-            'Authorization': 'Basic ' + base64.b64encode((username + ':' + password).encode('utf-8')).decode('utf-8'),
+            # Missing credentials are reported by _check_credentials, not by a TypeError here
+            'Authorization': 'Basic ' + base64.b64encode(
+                ((username or '') + ':' + (password or '')).encode('utf-8')).decode('utf-8'),
             'Content-type': 'application/json',
             'Accept': 'application/json'}
+        # Address payloads built for this batch of requests, see _get_cached_address
+        self.address_cache = {}
 
     def call_shipping_remote(self, data):
         self.debug_logger.info("start call remote api %s........", data)
@@ -30,7 +41,25 @@ class MPProvider():
         else:
             return response.json()
 
+    def _address_cache_key(self, address_type, *partners):
+        # write_date alone does not change when the partner is written in the same transaction as
+        # the batch (Odoo stamps it with the transaction start time), so the address values are
+        # part of the key as well and a partner edited during the batch is rebuilt
+        return (address_type,) + tuple(
+            (partner.id, partner.write_date) + tuple(partner[field] for field in ADDRESS_PAYLOAD_FIELDS)
+            for partner in partners)
+
+    def _get_cached_address(self, key, build_address):
+        if key not in self.address_cache:
+            self.address_cache[key] = build_address()
+        # A copy, so a caller altering its payload does not alter the one of the other pickings
+        return dict(self.address_cache[key])
+
     def _set_consignee(self, partner_id):
+        return self._get_cached_address(self._address_cache_key('consignee', partner_id),
+                                        lambda: self._build_consignee(partner_id))
+
+    def _build_consignee(self, partner_id):
         consignee = {}
         consignee['CompanyName'] = partner_id.commercial_company_name or partner_id.name
         consignee['AddressLine1'] = partner_id.street or partner_id.street2
@@ -50,6 +79,10 @@ class MPProvider():
         return consignee
 
     def _set_dct_to(self, partner_id):
+        return self._get_cached_address(self._address_cache_key('dct_to', partner_id),
+                                        lambda: self._build_dct_to(partner_id))
+
+    def _build_dct_to(self, partner_id):
         country_code = partner_id.country_id.code
         zip_code = partner_id.zip or ''
         return {
@@ -59,6 +92,11 @@ class MPProvider():
         }
 
     def _set_shipper(self, company_partner_id, warehouse_partner_id):
+        return self._get_cached_address(
+            self._address_cache_key('shipper', company_partner_id, warehouse_partner_id),
+            lambda: self._build_shipper(company_partner_id, warehouse_partner_id))
+
+    def _build_shipper(self, company_partner_id, warehouse_partner_id):
         shipper = {}
         shipper['CompanyName'] = company_partner_id.name
         shipper['AddressLine1'] = warehouse_partner_id.street or warehouse_partner_id.street2
@@ -78,7 +116,10 @@ class MPProvider():
         return shipper
 
     def _set_dct_from(self, warehouse_partner_id):
+        return self._get_cached_address(self._address_cache_key('dct_from', warehouse_partner_id),
+                                        lambda: self._build_dct_from(warehouse_partner_id))
 
+    def _build_dct_from(self, warehouse_partner_id):
         return {
             'country_code': warehouse_partner_id.country_id.code,
             'zip_code': warehouse_partner_id.zip,
@@ -142,19 +183,19 @@ class MPProvider():
     def _set_label(self, label):
         return label
 
-    def check_required_value(self, carrier, recipient, shipper, order=False, picking=False):
-        carrier = carrier.sudo()
-        recipient_required_field = ['city', 'zip', 'country_id']
+    def _check_credentials(self, carrier):
         if not carrier.mp_username:
             return _("MP Username missing, please modify your delivery method settings.")
         if not carrier.mp_password:
             return _("MP password is missing, please modify your delivery method settings.")
+        return False
 
+    def _check_addresses(self, recipient, shipper, partial_address=False):
+        """``recipient`` and ``shipper`` are partner records or their values read with ADDRESS_FIELDS."""
+        recipient_required_field = ['city', 'zip', 'country_id']
         # The street isn't required if we compute the rate with a partial delivery address in the
         # express checkout flow.
-        if not recipient.street and not recipient.street2 and not recipient._context.get(
-                'express_checkout_partial_delivery_address', False
-        ):
+        if not recipient['street'] and not recipient['street2'] and not partial_address:
             recipient_required_field.append('street')
         res = [field for field in recipient_required_field if not recipient[field]]
         if res:
@@ -162,62 +203,183 @@ class MPProvider():
                 res).replace("_id", "")
 
         shipper_required_field = ['city', 'zip', 'phone', 'country_id']
-        if not shipper.street and not shipper.street2:
+        if not shipper['street'] and not shipper['street2']:
             shipper_required_field.append('street')
 
         res = [field for field in shipper_required_field if not shipper[field]]
         if res:
             return _("The address of your company warehouse is missing or wrong (Missing field(s) :\n %s)") % ", ".join(
                 res).replace("_id", "")
+        return False
 
-        if order:
-            if not order.order_line:
-                return _("Please provide at least one item to ship.")
-            error_lines = order.order_line.filtered(lambda
-                                                        line: not line.product_id.weight and not line.is_delivery and line.product_id.type != 'service' and not line.display_type)
-            if error_lines:
+    def _check_items(self, lines, is_order):
+        """``lines`` holds a (product, is_delivery, display_type) triple per order line or move,
+        the product being a record or its values read with PRODUCT_FIELDS."""
+        if not lines:
+            return _("Please provide at least one item to ship.")
+        missing_weight = []
+        for product, is_delivery, display_type in lines:
+            if not product or product['weight'] or is_delivery or product['type'] == 'service' or display_type:
+                continue
+            if product['name'] not in missing_weight:
+                missing_weight.append(product['name'])
+        if missing_weight:
+            if is_order:
                 return _(
                     "The estimated shipping price cannot be computed because the weight is missing for the following product(s): \n %s") % ", ".join(
-                    error_lines.product_id.mapped('name'))
+                    missing_weight)
+            return _("The weight is missing for the following product(s): \n %s") % ", ".join(missing_weight)
         return False
 
+    def check_required_value(self, carrier, recipient, shipper, order=False, picking=False):
+        error = self._check_credentials(carrier.sudo()) or self._check_addresses(
+            recipient, shipper, recipient._context.get('express_checkout_partial_delivery_address', False))
+        if error:
+            return error
+        if order:
+            return self._check_items([(line.product_id, line.is_delivery, line.display_type)
+                                      for line in order.order_line], True)
+        if picking:
+            return self._check_items([(move.product_id, False, False) for move in picking.move_ids], False)
+        return False
+
+    def check_required_values(self, carrier, records):
+        """Pre-flight validation of a whole batch of sale orders or pickings.
+
+        Same checks as check_required_value, but partners, lines and products of
+        the batch are read once for all records. Returns a dict mapping the id
+        of each invalid record to its error message; an empty dict means the
+        whole batch can be sent.
+        """
+        error = self._check_credentials(carrier.sudo())
+        if error:
+            return dict.fromkeys(records.ids, error)
+
+        is_order = records._name == 'sale.order'
+        if is_order:
+            recipients = {record.id: record.partner_shipping_id.id for record in records}
+            shippers = {record.id: record.warehouse_id.partner_id.id for record in records}
+            lines = records.order_line.read(['order_id', 'product_id', 'is_delivery', 'display_type'], load=False)
+            line_record_field = 'order_id'
+        else:
+            recipients = {record.id: record.partner_id.id for record in records}
+            shippers = {record.id: record.picking_type_id.warehouse_id.partner_id.id for record in records}
+            lines = records.move_ids.read(['picking_id', 'product_id'], load=False)
+            line_record_field = 'picking_id'
+
+        partner_ids = set(recipients.values()) | set(shippers.values())
+        partners = records.env['res.partner'].browse(list(partner_ids - {False})).read(ADDRESS_FIELDS, load=False)
+        partner_values = {values['id']: values for values in partners}
+        empty_partner = dict.fromkeys(ADDRESS_FIELDS, False)
+
+        product_ids = {line['product_id'] for line in lines if line['product_id']}
+        products = records.env['product.product'].browse(list(product_ids)).read(PRODUCT_FIELDS, load=False)
+        product_values = {values['id']: values for values in products}
+
+        lines_by_record = {}
+        for line in lines:
+            lines_by_record.setdefault(line[line_record_field], []).append(
+                (product_values.get(line['product_id']), line.get('is_delivery'), line.get('display_type')))
+
+        partial_address = records.env.context.get('express_checkout_partial_delivery_address', False)
+        errors = {}
+        for record in records:
+            error = self._check_addresses(partner_values.get(recipients[record.id], empty_partner),
+                                          partner_values.get(shippers[record.id], empty_partner),
+                                          partial_address) \
+                or self._check_items(lines_by_record.get(record.id, []), is_order)
+            if error:
+                errors[record.id] = error
+        return errors
+
     def _set_export_declaration(self, carrier, picking, is_return=False):
-        export_lines = []
-        move_lines = picking.move_line_ids.filtered(lambda line: line.product_id.type in ['product', 'consu'])
-        currency_id = picking.sale_id and picking.sale_id.currency_id or picking.company_id.currency_id
-        for sequence, line in enumerate(move_lines, start=1):
-            if line.move_id.sale_line_id:
-                unit_quantity = line.product_uom_id._compute_quantity(line.qty_done,
-                                                                      line.move_id.sale_line_id.product_uom)
-            else:
-                unit_quantity = line.product_uom_id._compute_quantity(line.qty_done, line.product_id.uom_id)
-            rounded_qty = max(1, float_round(unit_quantity, precision_digits=0, rounding_method='HALF-UP'))
-            item = self.factory.ExportLineItem()
-            item.LineNumber = sequence
-            item.Quantity = int(rounded_qty)
-            item.QuantityUnit = 'PCS'  # Pieces - very generic
-            if len(line.product_id.name) > 75:
-                raise UserError(_("MP doesn't support products with name greater than 75 characters."))
-            item.Description = line.product_id.name
-            item.Value = float_repr(line.sale_price / rounded_qty, currency_id.decimal_places)
-            item.Weight = item.GrossWeight = {
-                "Weight": carrier._mp_convert_weight(line.product_id.weight, carrier.mp_package_weight_unit),
-                "WeightUnit": carrier.mp_package_weight_unit,
+        return self._set_export_declarations(carrier, picking, is_return=is_return)[picking.id]
+
+    def _set_export_declarations(self, carrier, pickings, is_return=False):
+        """Build the export declarations of a batch of pickings.
+
+        Move lines, products, units of measure and countries are read once for
+        the whole batch and the commercial invoice numbers are reserved as one
+        block, so the number of queries does not grow with the number of lines.
+        Returns a dict mapping each picking id to its declaration.
+        """
+        env = carrier.env
+        move_lines = pickings.move_line_ids.read(
+            ['picking_id', 'move_id', 'product_id', 'product_uom_id', 'qty_done', 'sale_price'], load=False)
+
+        product_ids = list({line['product_id'] for line in move_lines})
+        products = {values['id']: values for values in env['product.product'].browse(product_ids).read(
+            ['name', 'type', 'weight', 'uom_id', 'country_of_origin', 'hs_code'], load=False)}
+        move_lines = [line for line in move_lines if products[line['product_id']]['type'] in ['product', 'consu']]
+        # Checked before reserving the invoice numbers, which are lost if the transaction is rolled back
+        if any(len(products[line['product_id']]['name']) > 75 for line in move_lines):
+            raise UserError(_("MP doesn't support products with name greater than 75 characters."))
+
+        move_ids = list({line['move_id'] for line in move_lines if line['move_id']})
+        sale_line_ids = {values['id']: values['sale_line_id'] for values in
+                         env['stock.move'].browse(move_ids).read(['sale_line_id'], load=False)}
+        sale_line_uoms = {values['id']: values['product_uom'] for values in
+                          env['sale.order.line'].browse(list(set(sale_line_ids.values()) - {False})).read(
+                              ['product_uom'], load=False)}
+
+        country_ids = list({product['country_of_origin'] for product in products.values()} - {False})
+        country_codes = {country.id: country.code for country in env['res.country'].browse(country_ids)}
+
+        uom_ids = {line['product_uom_id'] for line in move_lines}
+        uom_ids |= {product['uom_id'] for product in products.values()} | set(sale_line_uoms.values())
+        uoms = {uom.id: uom for uom in env['uom.uom'].browse(list(uom_ids))}
+        conversion_factors = {}
+        weight_factor = carrier._mp_weight_conversion_factor()
+
+        lines_by_picking = {}
+        for line in move_lines:
+            lines_by_picking.setdefault(line['picking_id'], []).append(line)
+
+        invoice_numbers = carrier._mp_reserve_commercial_invoice_numbers(len(pickings))
+        invoice_date = datetime.today().strftime('%Y-%m-%d')
+        export_declarations = {}
+        for picking, invoice_number in zip(pickings, invoice_numbers):
+            currency_id = picking.sale_id and picking.sale_id.currency_id or picking.company_id.currency_id
+            warehouse_country_code = picking.picking_type_id.warehouse_id.partner_id.country_id.code
+            export_lines = []
+            for sequence, line in enumerate(lines_by_picking.get(picking.id, []), start=1):
+                product = products[line['product_id']]
+                from_uom = uoms[line['product_uom_id']]
+                sale_line_id = sale_line_ids.get(line['move_id'])
+                to_uom = uoms[sale_line_uoms[sale_line_id] if sale_line_id else product['uom_id']]
+                if (from_uom.id, to_uom.id) not in conversion_factors:
+                    conversion_factors[from_uom.id, to_uom.id] = to_uom.factor / from_uom.factor
+                # Same conversion as uom._compute_quantity, with the factor computed once per UoM pair
+                unit_quantity = float_round(line['qty_done'] * conversion_factors[from_uom.id, to_uom.id],
+                                            precision_rounding=to_uom.rounding, rounding_method='UP')
+                rounded_qty = max(1, float_round(unit_quantity, precision_digits=0, rounding_method='HALF-UP'))
+                weight = {
+                    'Weight': float_repr(product['weight'] * weight_factor, 3),
+                    'WeightUnit': carrier.mp_package_weight_unit,
+                }
+                item = {
+                    'LineNumber': sequence,
+                    'Quantity': int(rounded_qty),
+                    'QuantityUnit': 'PCS',  # Pieces - very generic
+                    'Description': product['name'],
+                    'Value': float_repr(line['sale_price'] / rounded_qty, currency_id.decimal_places),
+                    'Weight': weight,
+                    'GrossWeight': weight,
+                    'ManufactureCountryCode': country_codes.get(product['country_of_origin']) or warehouse_country_code,
+                }
+                if product['hs_code']:
+                    item['ImportCommodityCode'] = product['hs_code']
+                    item['CommodityCode'] = product['hs_code']
+                export_lines.append(item)
+
+            export_declaration = {
+                'InvoiceDate': invoice_date,
+                'InvoiceNumber': invoice_number,
+                'ExportLineItem': export_lines,
             }
-            item.ManufactureCountryCode = line.product_id.country_of_origin.code or line.picking_id.picking_type_id.warehouse_id.partner_id.country_id.code
-            if line.product_id.hs_code:
-                item.ImportCommodityCode = line.product_id.hs_code
-                item.CommodityCode = line.product_id.hs_code
-            export_lines.append(item)
-
-        export_declaration = self.factory.ExportDeclaration()
-        export_declaration.InvoiceDate = datetime.today()
-        export_declaration.InvoiceNumber = carrier.env['ir.sequence'].sudo().next_by_code(
-            'delivery_mp.commercial_invoice')
-        if is_return:
-            export_declaration.ExportReason = 'RETURN'
-
-        export_declaration.ExportLineItem = export_lines
-        if picking.sale_id.client_order_ref:
-            export_declaration.ReceiverReference = picking.sale_id.client_order_ref
-        return export_declaration
+            if is_return:
+                export_declaration['ExportReason'] = 'RETURN'
+            if picking.sale_id.client_order_ref:
+                export_declaration['ReceiverReference'] = picking.sale_id.client_order_ref
+            export_declarations[picking.id] = export_declaration
+        return export_declarations
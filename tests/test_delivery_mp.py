@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+import logging
+from unittest.mock import patch
+
+from odoo import Command
+from odoo.exceptions import UserError
+from odoo.tests import TransactionCase, tagged
+
+from odoo.addons.delivery_mp.models.mp_request import MPProvider
+
+
+@tagged('post_install', '-at_install')
+class TestDeliveryMP(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.carrier = cls.env.ref('delivery_mp.delivery_carrier_mp_dhl_paket_standard')
+        cls.warehouse = cls.env['stock.warehouse'].search([('company_id', '=', cls.env.company.id)], limit=1)
+        cls.country = cls.env.ref('base.de')
+        address = {
+            'street': 'Hauptstrasse 1',
+            'city': 'Berlin',
+            'zip': '10115',
+            'country_id': cls.country.id,
+            'phone': '+49 30 123456',
+        }
+        cls.warehouse.partner_id.write(address)
+        cls.customer = cls.env['res.partner'].create(dict(address, name='MP Customer'))
+        cls.customer_without_city = cls.env['res.partner'].create(dict(address, name='MP Customer', city=False))
+        cls.product = cls.env['product.product'].create({'name': 'MP Product', 'type': 'product', 'weight': 1.5})
+        cls.product_without_weight = cls.env['product.product'].create({
+            'name': 'MP Product Without Weight',
+            'type': 'product',
+        })
+        cls.service = cls.env['product.product'].create({'name': 'MP Service', 'type': 'service'})
+
+    def setUp(self):
+        super().setUp()
+        # One provider per test, as one provider (and its address cache) is used per batch
+        self.provider = MPProvider(logging.getLogger(__name__), 'mp_user', 'mp_password')
+
+    def _create_picking(self, partner, products):
+        picking_type = self.warehouse.out_type_id
+        return self.env['stock.picking'].create({
+            'partner_id': partner.id,
+            'picking_type_id': picking_type.id,
+            'location_id': picking_type.default_location_src_id.id,
+            'location_dest_id': self.env.ref('stock.stock_location_customers').id,
+            'carrier_id': self.carrier.id,
+            'move_ids': [Command.create({
+                'name': product.name,
+                'product_id': product.id,
+                'product_uom_qty': 1,
+                'product_uom': product.uom_id.id,
+                'location_id': picking_type.default_location_src_id.id,
+                'location_dest_id': self.env.ref('stock.stock_location_customers').id,
+            }) for product in products],
+        })
+
+    def test_send_shipping_missing_credentials(self):
+        picking = self._create_picking(self.customer, self.product)
+        self.carrier.sudo().mp_username = False
+        with self.assertRaisesRegex(UserError, 'MP Username missing'):
+            self.carrier.mp_send_shipping(picking)
+
+    def test_check_required_values_mixed_wave(self):
+        pickings = self._create_picking(self.customer, self.product) \
+            | self._create_picking(self.customer_without_city, self.product) \
+            | self._create_picking(self.customer, self.product)
+        errors = self.provider.check_required_values(self.carrier, pickings)
+        self.assertEqual(list(errors), [pickings[1].id])
+        self.assertIn('The address of the customer is missing or wrong', errors[pickings[1].id])
+        self.assertEqual(errors[pickings[1].id], self.provider.check_required_value(
+            self.carrier, self.customer_without_city, self.warehouse.partner_id, picking=pickings[1]))
+
+    def test_check_required_values_order_weight(self):
+        order = self.env['sale.order'].create({
+            'partner_id': self.customer.id,
+            'warehouse_id': self.warehouse.id,
+            'order_line': [
+                Command.create({'product_id': self.product.id, 'product_uom_qty': 1}),
+                Command.create({'product_id': self.product_without_weight.id, 'product_uom_qty': 1}),
+                Command.create({'product_id': self.service.id, 'product_uom_qty': 1}),
+                Command.create({'display_type': 'line_section', 'name': 'MP Section'}),
+            ],
+        })
+        # A delivery line without weight does not need one either
+        delivery_product = self.env['product.product'].create({'name': 'MP Delivery', 'type': 'consu'})
+        order.order_line = [Command.create({
+            'product_id': delivery_product.id,
+            'product_uom_qty': 1,
+            'is_delivery': True,
+        })]
+        errors = self.provider.check_required_values(self.carrier, order)
+        self.assertEqual(
+            errors[order.id],
+            "The estimated shipping price cannot be computed because the weight is missing for the following "
+            "product(s): \n MP Product Without Weight")
+        self.assertEqual(errors[order.id], self.provider.check_required_value(
+            self.carrier, self.customer, self.warehouse.partner_id, order=order))
+
+    def test_check_required_values_picking_weight(self):
+        picking = self._create_picking(self.customer, self.product | self.product_without_weight)
+        errors = self.provider.check_required_values(self.carrier, picking)
+        self.assertEqual(errors[picking.id],
+                         "The weight is missing for the following product(s): \n MP Product Without Weight")
+
+    def test_address_cache(self):
+        pickings = self._create_picking(self.customer, self.product) | self._create_picking(self.customer, self.product)
+        with patch.object(MPProvider, '_build_shipper', autospec=True,
+                          side_effect=MPProvider._build_shipper) as build_shipper, \
+                patch.object(MPProvider, '_build_consignee', autospec=True,
+                             side_effect=MPProvider._build_consignee) as build_consignee:
+            for picking in pickings:
+                self.provider._set_shipper(picking.company_id.partner_id,
+                                           picking.picking_type_id.warehouse_id.partner_id)
+                consignee = self.provider._set_consignee(picking.partner_id)
+            # The warehouse and company partner are shared by the wave, they are built once
+            self.assertEqual(build_shipper.call_count, 1)
+            self.assertEqual(build_consignee.call_count, 1)
+
+            # Altering a payload does not alter the cached one
+            consignee['City'] = 'Hamburg'
+            self.assertEqual(self.provider._set_consignee(self.customer)['City'], 'Berlin')
+            self.assertEqual(build_consignee.call_count, 1)
+
+            # A partner written during the batch is rebuilt
+            self.customer.city = 'Munich'
+            self.assertEqual(self.provider._set_consignee(self.customer)['City'], 'Munich')
+            self.assertEqual(build_consignee.call_count, 2)
+
+    def _create_done_pickings(self, count, product=None):
+        product = product or self.product
+        stock_location = self.warehouse.out_type_id.default_location_src_id
+        self.env['stock.quant']._update_available_quantity(product, stock_location, count)
+        pickings = self.env['stock.picking']
+        for dummy in range(count):
+            pickings |= self._create_picking(self.customer, product)
+        pickings.action_confirm()
+        pickings.action_assign()
+        for move_line in pickings.move_line_ids:
+            move_line.qty_done = 1
+        return pickings
+
+    def _get_commercial_invoice_sequence(self):
+        return self.env['ir.sequence'].search([('code', '=', 'delivery_mp.commercial_invoice')], limit=1)
+
+    def _assert_consecutive_numbers(self, sequence, numbers, first_number):
+        self.assertEqual(numbers, [sequence.get_next_char(first_number + index * sequence.number_increment)
+                                   for index in range(len(numbers))])
+        # The whole block is consumed: the next number follows it
+        self.assertEqual(sequence._next(),
+                         sequence.get_next_char(first_number + len(numbers) * sequence.number_increment))
+
+    def test_export_declarations(self):
+        picking = self._create_done_pickings(1)
+        declaration = self.provider._set_export_declaration(self.carrier, picking, is_return=True)
+        self.assertTrue(declaration['InvoiceNumber'])
+        self.assertEqual(declaration['ExportReason'], 'RETURN')
+        item, = declaration['ExportLineItem']
+        self.assertEqual(item['Quantity'], 1)
+        self.assertEqual(item['Description'], 'MP Product')
+        self.assertEqual(item['Weight'], {'Weight': '1.500', 'WeightUnit': 'K'})
+        # No country of origin on the product: the warehouse country is used
+        self.assertEqual(item['ManufactureCountryCode'], 'DE')
+
+    def test_export_declarations_query_count(self):
+        # Warm up the caches which do not depend on the batch (config parameters, xml ids)
+        self.provider._set_export_declarations(self.carrier, self._create_done_pickings(1))
+        small_wave = self._create_done_pickings(2)
+        large_wave = self._create_done_pickings(20)
+
+        self.env.flush_all()
+        self.env.invalidate_all()
+        queries_before = self.cr.sql_log_count
+        self.provider._set_export_declarations(self.carrier, small_wave)
+        self.env.flush_all()
+        query_count = self.cr.sql_log_count - queries_before
+
+        self.env.invalidate_all()
+        with self.assertQueryCount(query_count):
+            declarations = self.provider._set_export_declarations(self.carrier, large_wave)
+        self.assertEqual(len(declarations), 20)
+        numbers = [declarations[picking.id]['InvoiceNumber'] for picking in large_wave]
+        self.assertEqual(numbers, sorted(numbers))
+
+    def test_export_declarations_name_too_long(self):
+        long_name_product = self.env['product.product'].create({
+            'name': 'MP Product ' + 'x' * 80,
+            'type': 'product',
+            'weight': 1,
+        })
+        pickings = self._create_done_pickings(1) | self._create_done_pickings(1, long_name_product)
+        sequence = self._get_commercial_invoice_sequence()
+        number_next = sequence.number_next_actual
+        with self.assertRaises(UserError):
+            self.provider._set_export_declarations(self.carrier, pickings)
+        # No invoice number was drawn for the rejected wave
+        sequence.invalidate_recordset(['number_next_actual'])
+        self.assertEqual(sequence.number_next_actual, number_next)
+
+    def test_reserve_commercial_invoice_numbers_standard(self):
+        sequence = self._get_commercial_invoice_sequence()
+        self.assertEqual(sequence.implementation, 'standard')
+        first_number = sequence.number_next_actual
+        numbers = self.carrier._mp_reserve_commercial_invoice_numbers(5)
+        self._assert_consecutive_numbers(sequence, numbers, first_number)
+
+    def test_reserve_commercial_invoice_numbers_no_gap(self):
+        sequence = self._get_commercial_invoice_sequence()
+        sequence.implementation = 'no_gap'
+        first_number = sequence.number_next_actual
+        numbers = self.carrier._mp_reserve_commercial_invoice_numbers(5)
+        self._assert_consecutive_numbers(sequence, numbers, first_number)
+
+    def test_reserve_commercial_invoice_numbers_no_gap_negative_increment(self):
+        sequence = self._get_commercial_invoice_sequence()
+        sequence.write({'implementation': 'no_gap', 'number_increment': -1, 'number_next': 100})
+        numbers = self.carrier._mp_reserve_commercial_invoice_numbers(3)
+        self.assertEqual(numbers, ['CI00100', 'CI00099', 'CI00098'])
+        self._assert_consecutive_numbers(sequence, numbers, 100)
+
+    def test_reserve_commercial_invoice_numbers_date_range(self):
+        sequence = self._get_commercial_invoice_sequence()
+        sequence.use_date_range = True
+        numbers = self.carrier._mp_reserve_commercial_invoice_numbers(3)
+        self.assertEqual(len(set(numbers)), 3)
+        self.assertEqual(numbers, sorted(numbers))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+"""Benchmark of the wave label merge (models/mp_label.py).
+
+Generates synthetic 4x6" labels, spools them as mp_send_shipping does and
+merges them into one wave document, reporting the merge time and the peak
+memory for each wave size. It does not need an Odoo server, only PyPDF2 and
+Pillow; every measurement runs in its own process so the peak RSS is not
+polluted by the previous one.
+
+    python tools/benchmark_label_merge.py [--sizes 100 1000 5000] [--formats PDF PNG]
+"""
+import argparse
+import importlib.util
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from PIL import Image, ImageDraw
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'models', 'mp_label.py')
+# 4x6 inches at 203 dpi, the usual thermal printer label
+LABEL_SIZE = (812, 1218)
+
+
+def load_mp_label():
+    try:
+        import odoo.tools.pdf  # noqa: F401
+    except ImportError:
+        # Outside of an Odoo server, odoo.tools.pdf is a thin wrapper around PyPDF2
+        import PyPDF2
+        pdf_module = types.ModuleType('odoo.tools.pdf')
+        pdf_module.PdfFileReader = PyPDF2.PdfFileReader
+        sys.modules.setdefault('odoo', types.ModuleType('odoo'))
+        sys.modules.setdefault('odoo.tools', types.ModuleType('odoo.tools'))
+        sys.modules['odoo.tools.pdf'] = pdf_module
+    spec = importlib.util.spec_from_file_location('mp_label', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_label(label_format, seed):
+    rng = random.Random(seed)
+    image = Image.new('1', LABEL_SIZE, 1)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 20, LABEL_SIZE[0] - 20, LABEL_SIZE[1] - 20), outline=0, width=4)
+    # A barcode and a few text-like blocks, different for every label
+    x = 60
+    while x < LABEL_SIZE[0] - 60:
+        width = rng.choice((2, 4, 6))
+        draw.rectangle((x, 700, x + width, 950), fill=0)
+        x += width + rng.choice((2, 4, 6))
+    for row in range(12):
+        draw.rectangle((60, 80 + row * 45, 60 + rng.randint(150, 690), 105 + row * 45), fill=0)
+    stream = io.BytesIO()
+    image.save(stream, format=label_format)
+    return stream.getvalue()
+
+
+def run_one(label_format, count):
+    mp_label = load_mp_label()
+    label_bytes = 0
+    spool_time = 0.0
+    with mp_label.MPLabelSpool() as label_spool:
+        # Every label is different, as they would be in a real wave
+        for index in range(count):
+            label = make_label(label_format, index)
+            label_bytes += len(label)
+            start = time.perf_counter()
+            label_spool.add('WH/OUT/%05d' % index, label)
+            spool_time += time.perf_counter() - start
+            del label
+        # Timed without tracemalloc, which slows the merge down a lot, then merged again to trace its memory
+        with tempfile.SpooledTemporaryFile(max_size=mp_label.SPOOL_MAX_SIZE) as wave_stream:
+            start = time.perf_counter()
+            page_count, skipped = label_spool.merge(wave_stream)
+            merge_time = time.perf_counter() - start
+            wave_size = wave_stream.seek(0, io.SEEK_END)
+        tracemalloc.start()
+        with tempfile.SpooledTemporaryFile(max_size=mp_label.SPOOL_MAX_SIZE) as wave_stream:
+            label_spool.merge(wave_stream)
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+    assert page_count == count and not skipped
+    print('%s\t%d\t%.1f\t%.2f\t%.2f\t%.1f\t%.1f\t%.1f' % (
+        label_format, count, label_bytes / 1024 / 1024, spool_time, merge_time,
+        wave_size / 1024 / 1024, peak_traced / 1024 / 1024, peak_rss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--formats', nargs='+', default=['PDF', 'PNG'], choices=['PDF', 'PNG'])
+    parser.add_argument('--run-one', nargs=2, metavar=('FORMAT', 'COUNT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_one:
+        run_one(args.run_one[0], int(args.run_one[1]))
+        return
+    print('format\tlabels\tinput MiB\tspool s\tmerge s\twave MiB\tmerge peak traced MiB\tprocess peak RSS MiB')
+    for label_format in args.formats:
+        for count in args.sizes:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', label_format, str(count)],
+                           check=True)
+
+
+if __name__ == '__main__':
+    main()